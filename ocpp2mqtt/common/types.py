@@ -1,35 +1,70 @@
 # -*- coding: utf-8 -*-
 
-from datetime import datetime, timezone
-from dataclasses import dataclass, field
-from typing import Any, Dict, Literal
-from dataclasses_json import dataclass_json, DataClassJsonMixin
+import time
+from typing import Any, Literal, Optional, Union
+import msgspec
 
 
-@dataclass_json
-@dataclass
-class MessageData(DataClassJsonMixin):
-    """Data class for messages passed to the snoop queue."""
+# Most recent (second, formatted timestamp) pair. Bursts of messages arrive within
+# the same second, so formatting is needed only when the second changes.
+_ts_cache = [None, ""]
+
+def _utc_now_iso() -> str:
+    """Current UTC time formatted as YYYY-MM-DDTHH:MM:SSZ."""
+    sec = int(time.time())
+    if sec != _ts_cache[0]:
+        _ts_cache[1] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(sec))
+        _ts_cache[0] = sec
+    return _ts_cache[1]
+
+
+class MessageData(msgspec.Struct, gc=False):
+    """Data class for messages passed to the snoop queue.
+
+    The payload is decoded JSON, or the encoded frame as msgspec.Raw when the relay
+    forwards it unparsed. Neither can form reference cycles, so instances are not
+    tracked by the garbage collector."""
     event: Literal["Connection", "Disconnection", "Message"]
     sender: Literal["CP", "CSMS"]
-    protocol: str = None
-    cp_id: str = None
-    payload: Dict[str, Any] = field(default_factory=dict)
-    timestamp: str = field(default_factory=lambda: datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"))
-
-@dataclass_json
-@dataclass
-class MQTTData():
+    protocol: Optional[str] = None
+    cp_id: Optional[str] = None
+    # The OCPP message itself, normally a JSON array. The relay may pass the frame
+    # as msgspec.Raw, which is encoded verbatim.
+    payload: Any = msgspec.field(default_factory=dict)
+    timestamp: str = msgspec.field(default_factory=_utc_now_iso)
+
+    def to_json(self) -> str:
+        """Compatibility with the dataclasses_json API used previously."""
+        return encode_message(self).decode()
+
+class MQTTData(msgspec.Struct, gc=False):
     """Data class for messages passed to the MQTT queue. For Home Assistant the discovery
     topic will be homeassistant/device/ocpp/<unique_id>/config and the state will be
-    published to ocpp/<cp_id>/<topic>/state as value_json.<value_type>."""
-    cp_id: str = None
-    topic: str = None
-    manufacturer: str = None
-    unique_id: str = None
-    device_class: str = None
-    name: str = None
+    published to ocpp/<cp_id>/<topic>/state as value_json.<value_type>.
+
+    Instances hold only scalar values, so they are not tracked by the garbage collector."""
+    cp_id: Optional[str] = None
+    topic: Optional[str] = None
+    manufacturer: Optional[str] = None
+    unique_id: Optional[str] = None
+    device_class: Optional[str] = None
+    name: Optional[str] = None
     value: Any = None
-    value_type: str = None
-    unit: str = None
-    timestamp: str = None
+    value_type: Optional[str] = None
+    unit: Optional[str] = None
+    timestamp: Optional[str] = None
+
+
+_encoder = msgspec.json.Encoder()
+
+def encode_message(msg: MessageData) -> bytes:
+    """Encode msg as compact JSON. A single encoder is shared by all callers."""
+    return _encoder.encode(msg)
+
+
+_decoder = msgspec.json.Decoder(MessageData)
+
+def decode_message(data: Union[bytes, str]) -> MessageData:
+    """Decode JSON directly into a MessageData. Raises msgspec.DecodeError for invalid
+    JSON and msgspec.ValidationError (a subclass) for invalid fields."""
+    return _decoder.decode(data)
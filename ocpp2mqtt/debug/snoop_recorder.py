@@ -5,7 +5,7 @@ import argparse
 import asyncio
 import websockets
 import logging
-import json
+import orjson
 
 def parse_args():
     """Parse command line arguments."""
@@ -25,21 +25,54 @@ Map a stream of OCPP messages to MQTT topics.
     parser.add_argument('-o', '--output', type=str, default='output.json',
         help="""Output file (default: %(default)s).""")
 
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help="""Print each received message.""")
+
     global args
     args = parser.parse_args()
 
+# The output file is written when this many bytes are buffered or FLUSH_INTERVAL
+# seconds after the first unwritten message, whichever comes first.
+FLUSH_SIZE = 64 * 1024
+FLUSH_INTERVAL = 0.5
+
 async def receive_forever():
     uri = args.snoop_socket
     print(f"Connecting to {uri}...")
     try:
-        with open(args.output, "w", encoding="utf-8") as outfile:
-            async with websockets.connect(uri) as websocket:
-                print("Connection established. Waiting for messages...")
-                async for message in websocket:
-                    json_msg = json.loads(message)
-                    print(f"Client receives: < {json.dumps(json_msg, indent=2)}")
-                    outfile.write(json.dumps(json_msg) + "\n")
+        with open(args.output, "wb") as outfile:
+            loop = asyncio.get_running_loop()
+            buf = bytearray()
+            flush_timer = None
+
+            def flush():
+                nonlocal flush_timer
+                if flush_timer:
+                    flush_timer.cancel()
+                    flush_timer = None
+                if buf:
+                    outfile.write(buf)
                     outfile.flush()
+                    buf.clear()
+
+            try:
+                # Batched snoop frames can be large, so don't limit the message size
+                async with websockets.connect(uri, max_size=None) as websocket:
+                    print("Connection established. Waiting for messages...")
+                    async for message in websocket:
+                        # A frame holds one or more newline-separated JSON messages
+                        for line in message.split("\n"):
+                            json_msg = orjson.loads(line)
+                            if args.verbose:
+                                print(f"Client receives: < {orjson.dumps(json_msg, option=orjson.OPT_INDENT_2).decode()}")
+                            buf += orjson.dumps(json_msg, option=orjson.OPT_APPEND_NEWLINE)
+                        if len(buf) >= FLUSH_SIZE:
+                            flush()
+                        elif not flush_timer:
+                            flush_timer = loop.call_later(FLUSH_INTERVAL, flush)
+            finally:
+                # Write whatever is left, including after a closed connection
+                flush()
     except websockets.exceptions.ConnectionClosed as e:
         print(f"Connection closed: {e.code} ({e.reason})")
     except ConnectionRefusedError:
@@ -1,25 +1,79 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
-import json
+import collections
+import functools
 import logging
+import orjson
 import paho.mqtt.client as mqtt_client
 
 from ocpp2mqtt.common.types import MQTTData
 
+# Maximum number of queued messages published together by MQTTPublisher.run()
+MAX_BATCH = 128
+
+# Home Assistant appears to lose value messages if they arrive right after the
+# first discovery message for a sensor. Values for a newly discovered sensor are
+# held back for this many seconds.
+DISCOVERY_DELAY = 2.0
+
+# Constant parts of Home Assistant discovery messages. Keys in the component
+# templates whose values are None are filled in from the MQTTData.
+_ORIGIN = {
+    "name": "ocpp2mqtt",
+    "sw_version": "0.1",
+    "support_url": "https://github.com/michael-adler/ocpp2mqtt"
+    }
+
+_STATUS_COMPONENT = {
+    "expire_after": 0,
+    "force_update": "true",
+    "value_template": "{{ value_json.value }}"
+    }
+
+_HEARTBEAT_COMPONENT = {
+    "expire_after": 3600,
+    "force_update": "false",
+    "device_class": None,
+    "value_template": "{{ value_json.value }}"
+    }
+
+_METER_COMPONENT = {
+    "expire_after": 0,
+    "force_update": "true",
+    "value_template": "{{ value_json.value|float }}",
+    "unit_of_measurement": None,
+    "icon": "mdi:meter-electric-outline",
+    "device_class": None
+    }
+
+# Home Assistant state_class for meter device classes
+_STATE_CLASSES = {
+    "energy": "total_increasing",
+    "current": "measurement",
+    "power": "measurement",
+    "voltage": "measurement"
+    }
+
 class MQTTPublisher:
     def __init__(self, broker_host: str, broker_port: int = 1883,
                  broker_username: str = None, broker_password: str = None,
                  topic_prefix: str = "homeassistant"):
         self._logger = logging.getLogger(__name__)
-        self._queue = asyncio.Queue()
+        # Single producer, single consumer queue. The event is set when data is
+        # added so that run() can sleep while the queue is empty.
+        self._queue = collections.deque()
+        self._queue_event = asyncio.Event()
         self._broker_host = broker_host
         self._broker_port = broker_port
         self._broker_username = broker_username
         self._broker_password = broker_password
         self._topic_prefix = topic_prefix
         self._exit_task = False
-        self._connected = False
+        # Set from the paho thread once the first connection attempt completes,
+        # successfully or not. Uses self._loop, which start() sets.
+        self._connected_event = asyncio.Event()
+        self._loop = None
 
         self._mqtt = mqtt_client.Client()
         self._mqtt.connect_timeout = 60.0
@@ -28,45 +82,72 @@ class MQTTPublisher:
         self._mqtt.on_message = self._mqtt_on_message
 
         self._broker_connection_failed = False
+        # Indexed by discovery topic. Values are (discover dict, encoded payload) so
+        # re-publishing after a reconnect doesn't re-serialize every message.
         self._published_discoveries = {}
+        # Discovery topics indexed by unique_id
+        self._discovery_topics = {}
+        # Values held back after a new discovery message, indexed by unique_id.
+        # Entries are (timer handle, list of MQTTData).
+        self._deferred_values = {}
 
     async def publish_data(self, data: MQTTData):
         """Push an MQTTData instance onto the queue."""
-        await self._queue.put(data)
+        self._queue.append(data)
+        self._queue_event.set()
+
+    async def publish_many(self, data):
+        """Push all MQTTData instances from the iterable data onto the queue with a
+        single wakeup of the publisher."""
+        n = len(self._queue)
+        self._queue.extend(data)
+        if len(self._queue) != n:
+            self._queue_event.set()
 
     async def run(self):
         """Asyncio task: consume the queue and publish to MQTT broker."""
         last_msg_info = None
 
-        while not self._connected:
-            await asyncio.sleep(0.1)
-
-        while True:
-            try:
-                data: MQTTData = await asyncio.wait_for(self._queue.get(), timeout=5.0)
-
-                self._logger.info(f"Publishing {data}")
-
-                disc_info = self._mqtt_discover(data)
-                if disc_info:
-                    disc_info.wait_for_publish()
-                    # Home Assistant appears to lose value messages if this is really the
-                    # first time it has seen the discovery message, so wait a bit.
-                    await asyncio.sleep(2)
-
-                last_msg_info = self._mqtt_publish_data(data)
-
-                self._queue.task_done()
-            except asyncio.TimeoutError:
-                # Timeout is a chance to check for connection failure below
-                pass
-
-            if self._exit_task and self._queue.empty():
-                break
-            if self._broker_connection_failed:
-                self._logger.error("Broker connection failed, stopping publisher.")
+        await self._connected_event.wait()
+
+        while not self._broker_connection_failed:
+            if not self._queue:
+                self._queue_event.clear()
+                try:
+                    await asyncio.wait_for(self._queue_event.wait(), timeout=5.0)
+                except asyncio.TimeoutError:
+                    # Timeout is a chance to check for connection failure
+                    pass
+
+            while self._queue:
+                batch = []
+                while self._queue and len(batch) < MAX_BATCH:
+                    batch.append(self._queue.popleft())
+
+                # Publish any new discovery messages for the whole batch before the values.
+                # _mqtt_discover() skips topics that were already published.
+                for data in batch:
+                    self._logger.info("Publishing %s", data)
+                    if self._mqtt_discover(data):
+                        self._defer_values(data.unique_id)
+
+                for data in batch:
+                    deferred = self._deferred_values.get(data.unique_id)
+                    if deferred:
+                        deferred[1].append(data)
+                    else:
+                        last_msg_info = self._mqtt_publish_data(data)
+
+            if self._exit_task and not self._queue:
                 break
 
+        if self._broker_connection_failed:
+            self._logger.error("Broker connection failed, stopping publisher.")
+        else:
+            # Don't drop values that are still waiting for their discovery delay
+            for unique_id in list(self._deferred_values):
+                last_msg_info = self._publish_deferred(unique_id) or last_msg_info
+
         if last_msg_info:
             last_msg_info.wait_for_publish()
         self._mqtt.disconnect()
@@ -80,6 +161,7 @@ class MQTTPublisher:
         import sys
         self._logger.info(f"Connecting to MQTT broker at {self._broker_host}:{self._broker_port}...")
 
+        self._loop = asyncio.get_running_loop()
         self._mqtt.username_pw_set(username=self._broker_username, password=self._broker_password)
         self._mqtt.loop_start()
         self._mqtt.connect_async(self._broker_host, self._broker_port)
@@ -87,20 +169,41 @@ class MQTTPublisher:
 
     def stop(self):
         self._logger.info("Stopping MQTTPublisher...")
-        # self._queue.shutdown() would work well here, but it requires Python 3.11+
         self._exit_task = True
+        # Wake run() so it notices the request without waiting for a timeout
+        self._queue_event.set()
+
+    def _defer_values(self, unique_id: str):
+        """Hold back values for unique_id until DISCOVERY_DELAY passes. The queue
+        keeps draining for other sensors in the meantime."""
+        if unique_id in self._deferred_values:
+            return
+        timer = asyncio.get_running_loop().call_later(DISCOVERY_DELAY, self._publish_deferred, unique_id)
+        self._deferred_values[unique_id] = (timer, [])
+
+    def _publish_deferred(self, unique_id: str):
+        """Publish the values held back for unique_id, in arrival order."""
+        timer, values = self._deferred_values.pop(unique_id)
+        timer.cancel()
+        info = None
+        for data in values:
+            info = self._mqtt_publish_data(data)
+        return info
 
     def _mqtt_rediscover(self):
         """Re-publish discovery messages."""
-        for topic, discover in self._published_discoveries.items():
+        for topic, (_, payload) in self._published_discoveries.items():
             self._logger.info(f"Re-publishing discovery message for topic {topic}")
-            self._mqtt.publish(topic, json.dumps(discover), qos=1, retain=False)
+            self._mqtt.publish(topic, payload, qos=1, retain=False)
 
     def _mqtt_on_connect(self, client, userdata, flags, rc, properties=None):
         """Callback function for when the client connects to the MQTT broker."""
         if rc != 0:
             self._logger.error(f"Error connecting to {self._broker_host}:{self._broker_port}, return code {rc}")
             self._broker_connection_failed = True
+            # Wake run() in the event loop thread so it stops
+            self._loop.call_soon_threadsafe(self._connected_event.set)
+            self._loop.call_soon_threadsafe(self._queue_event.set)
             return
 
         self._logger.info(f"Connection successful to {self._broker_host}:{self._broker_port}...")
@@ -113,7 +216,7 @@ class MQTTPublisher:
         except Exception:
             self._logger.exception(f"Failed to subscribe to {status_topic}")
 
-        self._connected = True
+        self._loop.call_soon_threadsafe(self._connected_event.set)
 
     def _mqtt_on_connect_fail(self, client, userdata):
         """Callback function for when the client fails to connect to the MQTT broker."""
@@ -135,82 +238,86 @@ class MQTTPublisher:
         except Exception:
             self._logger.exception("Unhandled error in _mqtt_on_message")
 
-    def _mqtt_state_topic(self, data: MQTTData) -> str:
-        """Generate the MQTT state topic for the given data."""
-        return f"ocpp/{data.cp_id}/{data.topic}/state"
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _mqtt_state_topic(cp_id: str, topic: str) -> str:
+        """Generate the MQTT state topic for a charge point's topic."""
+        return f"ocpp/{cp_id}/{topic}/state"
+
+    def _mqtt_discovery_topic(self, unique_id: str) -> str:
+        """Generate the Home Assistant discovery topic for unique_id."""
+        topic = self._discovery_topics.get(unique_id)
+        if topic is None:
+            topic = f"{self._topic_prefix}/device/ocpp/{unique_id}/config"
+            self._discovery_topics[unique_id] = topic
+        return topic
 
     def _mqtt_discover(self, data: MQTTData):
         """Publish Home Assistant MQTT discovery message for the given data."""
-        state_topic = self._mqtt_state_topic(data)
-        topic = f"{self._topic_prefix}/device/ocpp/{data.unique_id}/config"
+        topic = self._mqtt_discovery_topic(data.unique_id)
 
         if topic in self._published_discoveries:
             return None # Already published
 
+        state_topic = self._mqtt_state_topic(data.cp_id, data.topic)
+
+        component = {
+            "platform": "sensor",
+            "unique_id": f"{data.unique_id}_value",
+            "name": data.name
+            }
+        if not data.device_class:
+            # Unknown value type, assume status
+            component.update(_STATUS_COMPONENT)
+        elif data.topic == "heartbeat":
+            component.update(_HEARTBEAT_COMPONENT)
+            component["device_class"] = data.device_class
+        else:
+            component.update(_METER_COMPONENT)
+            component["unit_of_measurement"] = data.unit
+            component["device_class"] = data.device_class
+            state_class = _STATE_CLASSES.get(data.device_class)
+            if state_class:
+                component["state_class"] = state_class
+
+        device = {
+            "identifiers": f"cp_{data.cp_id}",
+            "name": "EV Charge Point",
+            "serial_number": data.cp_id
+            }
+        if data.manufacturer:
+            device["manufacturer"] = data.manufacturer
+
         # For now the discovery messages have only one component since we might see OCPP measurement
         # packets with varying types. Using the config format makes it easy to extend later.
         # Home Assistant will group multiple components with the same device ID.
         discover = {
-            "device": {
-                "identifiers": f"cp_{data.cp_id}",
-                "name": "EV Charge Point",
-                "serial_number": data.cp_id
-                },
-            "origin": {
-                "name": "ocpp2mqtt",
-                "sw_version": "0.1",
-                "support_url": "https://github.com/michael-adler/ocpp2mqtt"
-                },
+            "device": device,
+            "origin": _ORIGIN,
             "components": {
-                f"{data.unique_id}_value": {
-                    "platform": "sensor",
-                    "unique_id": f"{data.unique_id}_value",
-                    "name": data.name,
-                    "expire_after": 0,
-                    "force_update": "true"
-                    }
+                f"{data.unique_id}_value": component
                 },
             "state_topic": state_topic,
             "qos": 1
             }
 
-        if data.manufacturer:
-            discover["device"]["manufacturer"] = data.manufacturer
-
-        if not data.device_class:
-            # Unknown value type, assume status
-            discover["components"][f"{data.unique_id}_value"]["value_template"] = "{{ value_json.value }}"
-        elif data.topic == "heartbeat":
-            discover["components"][f"{data.unique_id}_value"]["device_class"] = data.device_class
-            discover["components"][f"{data.unique_id}_value"]["value_template"] = "{{ value_json.value }}"
-            discover["components"][f"{data.unique_id}_value"]["expire_after"] = 3600
-            discover["components"][f"{data.unique_id}_value"]["force_update"] = "false"
-        else:
-            discover["components"][f"{data.unique_id}_value"]["value_template"] = "{{ value_json.value|float }}"
-            discover["components"][f"{data.unique_id}_value"]["unit_of_measurement"] = data.unit
-            discover["components"][f"{data.unique_id}_value"]["icon"] = "mdi:meter-electric-outline"
-            discover["components"][f"{data.unique_id}_value"]["device_class"] = data.device_class
-            if data.device_class == "energy":
-                discover["components"][f"{data.unique_id}_value"]["state_class"] = "total_increasing"
-            if data.device_class in ["current", "power", "voltage"]:
-                discover["components"][f"{data.unique_id}_value"]["state_class"] = "measurement"
-
-        self._logger.info(f"Publishing discovery message for {data} to topic {topic}")
-        info = self._mqtt.publish(topic, json.dumps(discover), qos=1, retain=False)
+        self._logger.info("Publishing discovery message for %s to topic %s", data, topic)
+        payload = orjson.dumps(discover)
+        info = self._mqtt.publish(topic, payload, qos=1, retain=False)
         if info.rc != mqtt_client.MQTT_ERR_SUCCESS:
             self._logger.error(f"Error publishing to topic {topic}: {info.rc}")
-        self._published_discoveries[topic] = discover
+        self._published_discoveries[topic] = (discover, payload)
         return info
 
     def _mqtt_publish_data(self, data: MQTTData):
         """Publish the given data to the MQTT broker."""
-        topic = self._mqtt_state_topic(data)
+        topic = self._mqtt_state_topic(data.cp_id, data.topic)
         payload = {
             "value": data.value
         }
 
-        self._logger.info(f"Publishing data {data} to topic {topic}")
-        info = self._mqtt.publish(topic, json.dumps(payload), qos=1, retain=False)
+        self._logger.info("Publishing data %s to topic %s", data, topic)
+        info = self._mqtt.publish(topic, orjson.dumps(payload), qos=1, retain=False)
         if info.rc != mqtt_client.MQTT_ERR_SUCCESS:
             self._logger.error(f"Error publishing to topic {topic}: {info.rc}")
         return info
@@ -1,56 +1,131 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import functools
 import logging
+import sys
+from typing import Callable, Iterator
 
 from ocpp2mqtt.common.types import MessageData, MQTTData
 
 
+# WebSocket subprotocol names mapped to the protocol versions used by the
+# OCPPFilter handler table. Other names are normalized by _handler_protocol().
+_PROTO_MAP = {
+    "ocpp1.6": "1.6",
+    "OCPP1.6": "1.6",
+    "ocpp2.0": "2.0",
+    "ocpp2.0.1": "2.0",
+    "OCPP2.0.1": "2.0",
+    "ocpp2.1": "2.0",
+}
+
+def _handler_protocol(protocol: str | None) -> str:
+    """Map a subprotocol name to "1.6" or "2.0". Anything other than 1.6
+    is treated as OCPP 2.0."""
+    proto = _PROTO_MAP.get(protocol)
+    if proto is None:
+        if protocol and protocol.lower().startswith("ocpp"):
+            protocol = protocol[4:]
+        proto = "1.6" if protocol == "1.6" else "2.0"
+    return proto
+
+
+# Values used when a sampled value doesn't specify them, as defined by OCPP
+_DEFAULT_MEASURAND = "Energy.Active.Import.Register"
+_DEFAULT_LOCATION = "Outlet"
+
+# Home Assistant device classes indexed by the first component of the measurand.
+# Other measurands are not forwarded to MQTT.
+_SENSOR_KIND = {
+    "Current": "current",
+    "Energy": "energy",
+    "Power": "power",
+    "Voltage": "voltage",
+}
+
+@functools.lru_cache(maxsize=4096, typed=True)
+def _meter_strings(cp_id: str, value_type: str, evse_id: int | str | None,
+                   location: str) -> tuple[str, str, str, str] | None:
+    """
+    Return (topic, unique_id, name, sensor_type) for a meter value or None if the
+    measurand isn't mapped to MQTT. Charge points report the same combinations over
+    and over, so the results are cached.
+    """
+    # Entries for every charge point and connector share one measurand string
+    value_type = sys.intern(value_type.replace(".", "-"))
+
+    sensor_type = _SENSOR_KIND.get(value_type.partition("-")[0])
+    if not sensor_type:
+        return None
+
+    # The topic and unique_id share their components. Measurand and location values
+    # don't contain "/", so only cp_id has to be made safe for unique_id.
+    parts = (str(evse_id), str(location), value_type)
+    topic = "/".join(parts)
+    unique_id = "_".join(("OCPP", str(cp_id).replace('/', '_'), *parts))
+    if not evse_id:
+        name = f"{value_type.replace('-', ' ')} {location} CP {cp_id}"
+    else:
+        name = f"C{evse_id} {value_type.replace('-', ' ')} {location} CP {cp_id}"
+
+    return (topic, unique_id, name, sensor_type)
+
+
 class OCPPFilter:
     """
     Stateful filter for OCPP messages. Returns lists of data that will
     be sent to MQTT."""
-    def __init__(self):
+    def __init__(self) -> None:
         self._logger = logging.getLogger()
-        # Will be indexed by cp_id
-        self._manufacturer = {}
+        # Will be indexed by cp_id. Unknown charge points have no manufacturer.
+        self._manufacturer = collections.defaultdict(lambda: None)
+        # Will be indexed by cp_id. Holds (subprotocol, handler protocol) so the
+        # subprotocol is normalized once per charge point connection.
+        self._protocol: dict[str | None, tuple[str | None, str]] = {}
 
-    def filter(self, msg: MessageData) -> list | None:
-        if msg.event != "Message": return None
-        if msg.sender != "CP": return None
+        # Message handlers indexed by (protocol, action). Any protocol other than
+        # 1.6 is treated as OCPP 2.0.
+        self._dispatch = {
+            ("1.6", "Heartbeat"): self._heartbeat,
+            ("2.0", "Heartbeat"): self._heartbeat,
+            ("1.6", "StatusNotification"): self._status_ocpp16,
+            ("1.6", "MeterValues"): self._meter_values_ocpp16,
+            ("2.0", "StatusNotification"): self._status_ocpp20,
+            ("2.0", "MeterValues"): self._meter_values_ocpp20,
+        }
 
-        cp_id = msg.cp_id
-        protocol = msg.protocol
-        if protocol and protocol.lower().startswith("ocpp"):
-            protocol = protocol[4:]
-        
-        # The OCPP message itself
+    def filter(self, msg: MessageData) -> list[MQTTData] | None:
+        """Return the list of MQTTData for msg or None if there is nothing to publish."""
+        return list(self.filter_iter(msg)) or None
+
+    def filter_iter(self, msg: MessageData) -> Iterator[MQTTData]:
+        """Generator version of filter(). Yields the MQTTData for msg one at a time, so
+        a MeterValues frame can be consumed without building an intermediate list."""
+        # Reject everything except requests from charge points before doing any work
+        if msg.event != "Message" or msg.sender != "CP":
+            return
+
+        # The OCPP message itself. All the messages of interest are requests
+        # with 4 top-level elements.
         ocpp = msg.payload
+        if type(ocpp) is not list or len(ocpp) < 4 or ocpp[0] != 2:
+            return
 
-        # All the messages of interest have 4 top-level elements
-        if not isinstance(ocpp, list) or len(ocpp) < 4:
-            return None
-        # Look only for requests
-        if ocpp[0] != 2:
-            return None
+        cp_id = msg.cp_id
 
-        if cp_id not in self._manufacturer:
-            self._manufacturer[cp_id] = None
         if not self._manufacturer[cp_id]:
             self._manufacturer[cp_id] = self._get_manufacturer(ocpp)
 
-        if ocpp[2] == "Heartbeat":
-            m = self._new_MQTTData(cp_id, msg.timestamp)
-            m.topic = "heartbeat"
-            m.unique_id = f"OCPP_{cp_id}_heartbeat"
-            m.name = f"Heartbeat CP {cp_id}"
-            m.device_class = "timestamp"
-            m.value = msg.timestamp
-            return [m]
-
-        if protocol == "1.6":
-            return self._filter_ocpp16(cp_id, msg.timestamp, ocpp)
-        else:
-            return self._filter_ocpp20(cp_id, msg.timestamp, ocpp)
+        protocol = self._protocol.get(cp_id)
+        if protocol is None or protocol[0] != msg.protocol:
+            # First message from cp_id or it reconnected with another subprotocol
+            protocol = (msg.protocol, _handler_protocol(msg.protocol))
+            self._protocol[cp_id] = protocol
+
+        handler = self._dispatch.get((protocol[1], ocpp[2]))
+        if handler:
+            yield from handler(cp_id, msg.timestamp, ocpp[3])
 
     def _get_manufacturer(self, ocpp: list) -> str | None:
         """
@@ -65,135 +140,126 @@ class OCPPFilter:
 
         return None
 
-    def _new_MQTTData(self, cp_id: str, timestamp: str) -> MQTTData:
-        m = MQTTData()
-        m.cp_id = cp_id
-        m.manufacturer = self._manufacturer[cp_id]
-        m.timestamp = timestamp
-        return m
+    def _new_MQTTData(self, cp_id: str, timestamp: str, **fields) -> MQTTData:
+        """
+        Create a new MQTTData instance for cp_id. All fields are set in the constructor.
+        """
+        return MQTTData(cp_id=cp_id, manufacturer=self._manufacturer[cp_id],
+                        timestamp=timestamp, **fields)
 
-    def _new_meter_MQTTData(self, cp_id: str, timestamp: str, value_type: str,
-                            evse_id: str, location: str,
-                            value: str, unit: str) -> MQTTData:
+    def _new_meter_MQTTData(self, cp_id: str, timestamp: str, value_type: str | None,
+                            evse_id: int | str | None, location: str | None,
+                            value: str, unit: str | None) -> MQTTData | None:
         """
         Create a new MQTTData instance for a meter value. This code is common to OCPP 1.6
         and OCPP 2.0.
         """
         if not isinstance(value_type, str):
-            value_type = "Energy.Active.Import.Register"
-        value_type = value_type.replace(".", "-")
+            value_type = _DEFAULT_MEASURAND
+        if not location:
+            location = _DEFAULT_LOCATION
 
-        if not isinstance(value_type, str):
+        try:
+            strings = _meter_strings(cp_id, value_type, evse_id, location)
+        except TypeError:
+            # Unhashable values in a malformed message can't be cached
+            strings = _meter_strings.__wrapped__(cp_id, value_type, evse_id, location)
+        if not strings:
             return None
 
-        if value_type.startswith("Current"):
-            sensor_type = 'current'
-        elif value_type.startswith("Energy"):
-            sensor_type = 'energy'
-        elif value_type.startswith("Power"):
-            sensor_type = 'power'
-        elif value_type.startswith("Voltage"):
-            sensor_type = 'voltage'
+        topic, unique_id, name, sensor_type = strings
+        return self._new_MQTTData(cp_id, timestamp,
+                                  topic=topic,
+                                  unique_id=unique_id,
+                                  name=name,
+                                  value=value,
+                                  device_class=sensor_type,
+                                  unit=unit)
+
+    def _status_MQTTData(self, cp_id: str, timestamp: str, cable_id: int | str | None,
+                         status: str) -> MQTTData:
+        """
+        Create a new MQTTData instance for a status notification. This code is common
+        to OCPP 1.6 and OCPP 2.0.
+        """
+        if not cable_id:
+            name = f"Status CP {cp_id}"
         else:
-            return None
+            name = f"C{cable_id} Status CP {cp_id}"
+        return self._new_MQTTData(cp_id, timestamp,
+                                  topic=f"{cable_id}/status",
+                                  unique_id=f"OCPP_{cp_id}_{cable_id}_status",
+                                  name=name,
+                                  value=status)
 
-        if not location:
-            location = "Outlet"
+    def _meter_values(self, cp_id: str, timestamp: str, payload: dict,
+                      evse_id: int | str | None,
+                      unit_of: Callable[[dict], str | None]) -> Iterator[MQTTData]:
+        """
+        Yield an MQTTData instance for each supported sampled value in a MeterValues
+        payload. The loop is common to OCPP 1.6 and OCPP 2.0. unit_of extracts the unit
+        from a sampled value.
+        """
+        # Bind lookups to locals. The inner loop runs once per sampled value.
+        new_meter_MQTTData = self._new_meter_MQTTData
+        for mv in payload.get('meterValue', ()):
+            for v in mv.get('sampledValue', ()):
+                g = v.get
+                m = new_meter_MQTTData(cp_id, timestamp, g('measurand'),
+                                       evse_id,
+                                       g('location'),
+                                       g('value'), unit_of(v))
+                if m:
+                    yield m
 
-        m = self._new_MQTTData(cp_id, timestamp)
-        m.topic = f"{evse_id}/{location}/{value_type}"
-        m.unique_id = f"OCPP_{cp_id}_{m.topic}".replace('/', '_')
+    def _heartbeat(self, cp_id: str, timestamp: str, payload: dict) -> list[MQTTData]:
+        # Heartbeat is the same in OCPP 1.6 and OCPP 2.0
+        return [self._new_MQTTData(cp_id, timestamp,
+                                   topic="heartbeat",
+                                   unique_id=f"OCPP_{cp_id}_heartbeat",
+                                   name=f"Heartbeat CP {cp_id}",
+                                   device_class="timestamp",
+                                   value=timestamp)]
 
-        if not evse_id:
-            m.name = f"{value_type.replace('-', ' ')} {location} CP {cp_id}"
-        else:
-            m.name = f"C{evse_id} {value_type.replace('-', ' ')} {location} CP {cp_id}"
+    #
+    # OCPP 1.6 handlers
+    #
 
-        m.value = value
-        m.device_class = sensor_type
-        m.unit = unit
+    def _status_ocpp16(self, cp_id: str, timestamp: str, payload: dict) -> list[MQTTData]:
+        self._logger.debug("OCPP 1.6 StatusNotification from %s: %s", cp_id, payload)
+        return [self._status_MQTTData(cp_id, timestamp, payload.get('connectorId'),
+                                      payload.get('status'))]
 
-        return m
+    def _meter_values_ocpp16(self, cp_id: str, timestamp: str, payload: dict) -> Iterator[MQTTData]:
+        self._logger.debug("OCPP 1.6 MeterValues from %s: %s", cp_id, payload)
+        return self._meter_values(cp_id, timestamp, payload, payload.get('connectorId'),
+                                  _unit_ocpp16)
 
-    def _filter_ocpp16(self, cp_id: str, timestamp: str, ocpp: list) -> list | None:
-        """
-        Filter OCPP 1.6 messages.
-        """
-        action = ocpp[2]
-        payload = ocpp[3]
+    #
+    # OCPP 2.0 handlers
+    #
+    # *** These handlers are untested and need to be verified with a charge point using OCPP 2.0 ***
+    #
 
-        if action == "StatusNotification":
-            self._logger.debug(f"OCPP 1.6 StatusNotification from {cp_id}: {payload}")
-            m = self._new_MQTTData(cp_id, timestamp)
-            cable_id = payload.get('connectorId')
-            m.topic = f"{cable_id}/status"
-            m.unique_id = f"OCPP_{cp_id}_{cable_id}_status"
-            if not cable_id:
-                m.name = f"Status CP {cp_id}"
-            else:
-                m.name = f"C{cable_id} Status CP {cp_id}"
-            m.value = payload.get('status')
-            return [m]
-        elif action == "MeterValues":
-            self._logger.debug(f"OCPP 1.6 MeterValues from {cp_id}: {payload}")
-            messages = []
-            for mv in payload.get('meterValue', []):
-                for v in mv.get('sampledValue', []):
-                    m = self._new_meter_MQTTData(cp_id, timestamp, v.get('measurand'),
-                                                 payload.get('connectorId'),
-                                                 v.get('location'),
-                                                 v.get('value'), v.get('unit'))
-                    if not m:
-                        continue
-
-                    messages.append(m)
-            return messages
+    def _status_ocpp20(self, cp_id: str, timestamp: str, payload: dict) -> list[MQTTData]:
+        self._logger.debug("OCPP 2.0 StatusNotification from %s: %s", cp_id, payload)
+        # Use evseId for OCPP 2.0. The connectorId indicates a cable within the evseId
+        # but only one cable can be active at a time. The MeterValues are per evseId, so
+        # record status globally for the evseId.
+        return [self._status_MQTTData(cp_id, timestamp, payload.get('evseId'),
+                                      payload.get('connectorStatus'))]
 
-        return None
-    
-    def _filter_ocpp20(self, cp_id: str, timestamp: str, ocpp: list) -> list | None:
-        """
-        Filter OCPP 2.0 messages.
+    def _meter_values_ocpp20(self, cp_id: str, timestamp: str, payload: dict) -> Iterator[MQTTData]:
+        self._logger.debug("OCPP 2.0 MeterValues from %s: %s", cp_id, payload)
+        return self._meter_values(cp_id, timestamp, payload, payload.get('evseId'),
+                                  _unit_ocpp20)
 
-        *** This filter is untested and needs to be verified with a charge point using OCPP 2.0 ***
-        """
-        action = ocpp[2]
-        payload = ocpp[3]
 
-        if action == "StatusNotification":
-            self._logger.debug(f"OCPP 2.0 StatusNotification from {cp_id}: {payload}")
-            m = self._new_MQTTData(cp_id, timestamp)
-            # Use evseId for OCPP 2.0. The connectorId indicates a cable within the evseId
-            # but only one cable can be active at a time. The MeterValues are per evseId, so
-            # record status globally for the evseId.
-            cable_id = payload.get('evseId')
-            m.topic = f"{cable_id}/status"
-            m.unique_id = f"OCPP_{cp_id}_{cable_id}_status"
-            if not cable_id:
-                m.name = f"Status CP {cp_id}"
-            else:
-                m.name = f"C{cable_id} Status CP {cp_id}"
-            m.value = payload.get('connectorStatus')
-            return [m]
-        elif action == "MeterValues":
-            self._logger.debug(f"OCPP 2.0 MeterValues from {cp_id}: {payload}")
-            messages = []
-            for mv in payload.get('meterValue', []):
-                for v in mv.get('sampledValue', []):
-                    unit = v.get('unitOfMeasure')
-                    if not unit:
-                        unit = 'Wh'
-                    else:
-                        unit = unit.get('unit')
-
-                    m = self._new_meter_MQTTData(cp_id, timestamp, v.get('measurand'),
-                                                 payload.get('evseId'),
-                                                 v.get('location'),
-                                                 v.get('value'), unit)
-                    if not m:
-                        continue
-
-                    messages.append(m)
-            return messages
-
-        return None
\ No newline at end of file
+def _unit_ocpp16(v: dict) -> str | None:
+    return v.get('unit')
+
+def _unit_ocpp20(v: dict) -> str | None:
+    unit = v.get('unitOfMeasure')
+    if not unit:
+        return 'Wh'
+    return unit.get('unit')
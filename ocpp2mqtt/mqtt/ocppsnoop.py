@@ -2,9 +2,9 @@
 
 import websockets
 import logging
-import json
+import msgspec
 
-from ocpp2mqtt.common.types import MessageData
+from ocpp2mqtt.common.types import decode_message
 
 
 async def receive_ocpp_snoop(ws_uri: str):
@@ -16,14 +16,17 @@ async def receive_ocpp_snoop(ws_uri: str):
     """
     logger = logging.getLogger()
     logger.info(f"Connecting to {ws_uri}...")
-    async for websocket in websockets.connect(ws_uri):
+    # Batched snoop frames can be large, so don't limit the message size
+    async for websocket in websockets.connect(ws_uri, max_size=None):
         try:
             async for message in websocket:
-                try:
-                    msg = MessageData(**json.loads(message))
-                    yield msg
-                except json.JSONDecodeError as e:
-                    logger.error(f"Error decoding JSON: {e}\nMessage: {message}")
+                # A frame holds one or more newline-separated JSON messages
+                for line in message.split("\n"):
+                    try:
+                        msg = decode_message(line)
+                        yield msg
+                    except msgspec.DecodeError as e:
+                        logger.error(f"Error decoding JSON: {e}\nMessage: {line}")
         except websockets.exceptions.ConnectionClosed as e:
             logger.info(f"Connection closed: {e.code} ({e.reason}). Retrying...")
             continue
@@ -39,13 +42,14 @@ def receive_ocpp_from_file(file_path: str):
     logger = logging.getLogger()
     logger.info(f"Reading OCPP messages from {file_path}...")
     try:
-        with open(file_path, "r", encoding="utf-8") as infile:
+        # msgspec decodes UTF-8 bytes directly, so the lines aren't decoded to str first
+        with open(file_path, "rb") as infile:
             for line in infile:
                 try:
-                    msg = MessageData(**json.loads(line))
+                    msg = decode_message(line)
                     yield msg
-                except json.JSONDecodeError as e:
-                    logger.error(f"Error decoding JSON: {e}\nLine: {line}")
+                except msgspec.DecodeError as e:
+                    logger.error(f"Error decoding JSON: {e}\nLine: {line.decode(errors='replace')}")
     except FileNotFoundError:
         logger.error(f"File not found: {file_path}")
     except Exception as e:
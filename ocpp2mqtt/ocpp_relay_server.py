@@ -3,6 +3,7 @@
 
 import argparse
 import asyncio
+import functools
 import logging
 from logging.handlers import SysLogHandler
 import os
@@ -13,6 +14,11 @@ import yaml
 from ocpp2mqtt.relay.ocpprelay import OCPPRelay
 from ocpp2mqtt.relay.snoopws import SnoopWebSocketServer
 
+# Log formats for stdout and for syslog, which adds its own timestamp
+LOG_FORMAT = '%(asctime)s - [%(levelname)-4.4s] - [%(threadName)-7.7s] - [%(name)-20.20s] - %(message)s'
+SYSLOG_FORMAT = 'ocpp-relay-server: %(levelname)s - %(threadName)s - %(name)s - %(message)s'
+
+
 def parse_args():
     """Parse command line arguments."""
 
@@ -54,6 +60,13 @@ all charge points. The JSON stream passed to snoop clients includes charge point
         help="""Snoop server interface address (default: %(default)s).""")
     parser.add_argument('--snoop-port', type=int, default=8501,
         help="""Snoop server port for clients that monitor OCPP traffic (default: %(default)d).""")
+    parser.add_argument('--snoop-compression', choices=['deflate', 'none'], default=None,
+        help="""Snoop WebSocket compression. Compression saves bandwidth on real networks but
+            costs CPU (default: none for localhost, otherwise deflate).""")
+
+    parser.add_argument('--socket-buffer-size', type=int, default=None,
+        help="""Send and receive buffer size in bytes for charge point, CPMS and snoop
+            sockets (default: operating system default).""")
 
     parser.add_argument('--ssl-cert', default=None,
         help="""Path to SSL certificate file (default: None). Some chargers don't store
@@ -84,53 +97,70 @@ all charge points. The JSON stream passed to snoop clients includes charge point
             print(f"Error loading config file {preliminary.config}: {e}", file=sys.stderr)
             sys.exit(1)
 
-    # Apply YAML defaults where CLI didn't explicitly set a value
+    # Apply YAML defaults where CLI didn't explicitly set a value. Options given
+    # as --name=value are matched by name.
+    argv_set = {a.split('=', 1)[0] for a in sys.argv[1:]}
     for key, val in yaml_defaults.items():
         argname = f"--{key.replace('_', '-') }"
         # Only set default if not explicitly provided on the command line
-        if not any(argname in a for a in sys.argv[1:]):
+        if argname not in argv_set:
             dest = key
             if hasattr(parser, 'get_default'):
                 parser.set_defaults(**{dest: val})
 
-    global args
     args = parser.parse_args()
 
     if not args.cpms:
         print("CPMS URL must be set, either in a YAML config file or with --cpms.", file=sys.stderr)
         sys.exit(1)
 
+    return args
 
+
+@functools.lru_cache(maxsize=1)
 def get_ssl_context(ssl_cert, ssl_key):
-    """Return an SSL context if both ssl_cert and ssl_key are provided, else None."""
+    """Return an SSL context if both ssl_cert and ssl_key are provided, else None.
+    The context is built once and shared by all servers."""
     if not ssl_cert or not ssl_key:
         return None
 
     ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     ssl_context.load_cert_chain(certfile=ssl_cert, keyfile=ssl_key)
+    # Many chargers don't support TLS 1.3 yet, so TLS 1.2 is the minimum.
+    ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
+    ssl_context.options |= ssl.OP_NO_COMPRESSION
     return ssl_context
 
 
-async def core():
+async def core(args):
     ssl_context = get_ssl_context(args.ssl_cert, args.ssl_key)
 
     # Stream of messages passed by the OCPP relay. The stream is used to monitor
-    # data and forward it to clients on the snoop port.
-    msg_queue = asyncio.Queue()
-
-    relay = OCPPRelay(args.cpms, snoop_queue=msg_queue)
-    relay_server = await relay.start(args.ocpp_host, args.ocpp_port, ssl_context=ssl_context)
+    # data and forward it to clients on the snoop port. The queue is bounded so a
+    # stalled snoop client can't grow it without limit. The relay drops the
+    # oldest messages when it is full.
+    msg_queue = asyncio.Queue(maxsize=10000)
 
     # Snoop server to allow clients to connect and receive a copy of all messages
     # exchanged between charge points and the CSMS. Don't use SSL for localhost.
-    snoop = SnoopWebSocketServer(snoop_queue=msg_queue)
+    snoop = SnoopWebSocketServer(snoop_queue=msg_queue,
+                                 socket_buffer_size=args.socket_buffer_size)
+    snoop_compression = args.snoop_compression
+    if not snoop_compression:
+        snoop_compression = 'none' if args.snoop_host == 'localhost' else 'deflate'
     snoop_server = await snoop.start(args.snoop_host, args.snoop_port,
-        ssl_context=(None if args.snoop_host == 'localhost' else ssl_context))
+        ssl_context=(None if args.snoop_host == 'localhost' else ssl_context),
+        compression=(None if snoop_compression == 'none' else snoop_compression))
+
+    # The relay skips the snoop queue while no snoop clients are connected
+    relay = OCPPRelay(args.cpms, snoop_queue=msg_queue, snoop_enabled=snoop.has_subscribers,
+                      socket_buffer_size=args.socket_buffer_size)
+    relay_server = await relay.start(args.ocpp_host, args.ocpp_port, ssl_context=ssl_context)
 
     await asyncio.gather(relay_server.wait_closed(), snoop_server.wait_closed())
 
 def main():
-    parse_args()
+    args = parse_args()
 
     # Configure logging. If --syslog is set, send logs to the system logger.
     level = logging.DEBUG if args.verbose else logging.INFO
@@ -145,17 +175,23 @@ def main():
             handler = SysLogHandler(address=address, facility=SysLogHandler.LOG_LOCAL0)
             logging.basicConfig(level=level,
                 handlers=[handler],
-                format='ocpp-relay-server: %(levelname)s - %(threadName)s - %(name)s - %(message)s')
+                format=SYSLOG_FORMAT)
         except Exception:
             # Fall back to basic config if SysLogHandler fails
-            logging.basicConfig(level=level,
-                                format='%(asctime)s - [%(levelname)-4.4s] - [%(threadName)-7.7s] - [%(name)-20.20s] - %(message)s')
+            logging.basicConfig(level=level, format=LOG_FORMAT)
     else:
-        logging.basicConfig(level=level,
-            format='%(asctime)s - [%(levelname)-4.4s] - [%(threadName)-7.7s] - [%(name)-20.20s] - %(message)s')
+        logging.basicConfig(level=level, format=LOG_FORMAT)
+
+    # Use the faster uvloop event loop when it is installed. uvloop.run() was
+    # added in uvloop 0.18. Older versions fall back to the asyncio loop.
+    try:
+        import uvloop
+        run = getattr(uvloop, "run", asyncio.run)
+    except ImportError:
+        run = asyncio.run
 
     try:
-        asyncio.run(core())
+        run(core(args))
     except KeyboardInterrupt:
         print("Exiting...")
 
@@ -13,6 +13,11 @@ from ocpp2mqtt.mqtt.mqttpublish import MQTTPublisher
 from ocpp2mqtt.mqtt.ocppsnoop import receive_ocpp_snoop, receive_ocpp_from_file
 from ocpp2mqtt.mqtt.ocppfilter import OCPPFilter
 
+# Log formats for stdout and for syslog, which adds its own timestamp
+LOG_FORMAT = '%(asctime)s - [%(levelname)-4.4s] - [%(threadName)-7.7s] - [%(name)-20.20s] - %(message)s'
+SYSLOG_FORMAT = 'ocpp-snoop2mqtt: %(levelname)s - %(threadName)s - %(name)s - %(message)s'
+
+
 def parse_args():
     """Parse command line arguments."""
 
@@ -63,37 +68,38 @@ Map a stream of OCPP messages to MQTT topics.
             print(f"Error loading config file {preliminary.config}: {e}", file=sys.stderr)
             sys.exit(1)
 
-    # Apply YAML defaults where CLI didn't explicitly set a value
+    # Apply YAML defaults where CLI didn't explicitly set a value. Options given
+    # as --name=value are matched by name.
+    argv_set = {a.split('=', 1)[0] for a in sys.argv[1:]}
     for key, val in yaml_defaults.items():
         argname = f"--{key.replace('_', '-') }"
         # Only set default if not explicitly provided on the command line
-        if not any(argname in a for a in sys.argv[1:]):
+        if argname not in argv_set:
             dest = key
             if hasattr(parser, 'get_default'):
                 parser.set_defaults(**{dest: val})
 
-    global args
-    args = parser.parse_args()
+    return parser.parse_args()
 
 
-async def process_messages(publisher):
+async def process_messages(args, publisher):
     logger = logging.getLogger()
     ocpp_filter = OCPPFilter()
 
     async for msg in receive_ocpp_snoop(ws_uri=args.snoop_socket):
     #for msg in receive_ocpp_from_file("../ocpp2mqtt.orig/output.json"):
-        filtered = ocpp_filter.filter(msg)
-        if filtered:
+        filtered = ocpp_filter.filter_iter(msg)
+        if logger.isEnabledFor(logging.INFO):
+            filtered = list(filtered)
             for m in filtered:
-                logger.info(f"Handle message: {m}")
-                await publisher.publish_data(m)
+                logger.info("Handle message: %s", m)
+        await publisher.publish_many(filtered)
 
     logger.info("Message source closed. Stopping publisher...")
     publisher.stop()
 
 
-async def core():
-    global args
+async def core(args):
     logger = logging.getLogger()
 
     # Instantiate the MQTT publisher
@@ -105,11 +111,11 @@ async def core():
     # Run both publisher and message processing concurrently
     await asyncio.gather(
         publisher.start(),
-        process_messages(publisher)
+        process_messages(args, publisher)
         )
 
 def main():
-    parse_args()
+    args = parse_args()
 
     # Configure logging. If --syslog is set, send logs to the system logger.
     level = logging.DEBUG if args.verbose else logging.INFO
@@ -124,17 +130,23 @@ def main():
             handler = SysLogHandler(address=address, facility=SysLogHandler.LOG_LOCAL0)
             logging.basicConfig(level=level,
                 handlers=[handler],
-                format='ocpp-snoop2mqtt: %(levelname)s - %(threadName)s - %(name)s - %(message)s')
+                format=SYSLOG_FORMAT)
         except Exception:
             # Fall back to basic config if SysLogHandler fails
-            logging.basicConfig(level=level,
-                                format='%(asctime)s - [%(levelname)-4.4s] - [%(threadName)-7.7s] - [%(name)-20.20s] - %(message)s')
+            logging.basicConfig(level=level, format=LOG_FORMAT)
     else:
-        logging.basicConfig(level=level,
-            format='%(asctime)s - [%(levelname)-4.4s] - [%(threadName)-7.7s] - [%(name)-20.20s] - %(message)s')
+        logging.basicConfig(level=level, format=LOG_FORMAT)
+
+    # Use the faster uvloop event loop when it is installed. uvloop.run() was
+    # added in uvloop 0.18. Older versions fall back to the asyncio loop.
+    try:
+        import uvloop
+        run = getattr(uvloop, "run", asyncio.run)
+    except ImportError:
+        run = asyncio.run
 
     try:
-        asyncio.run(core())
+        run(core(args))
     except KeyboardInterrupt:
         print("Exiting...")
         sys.exit(1)
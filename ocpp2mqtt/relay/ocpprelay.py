@@ -6,11 +6,17 @@
 
 import asyncio
 import base64
-import json
 import logging
+import msgspec
+import orjson
 import websockets
 
 from ocpp2mqtt.common.types import MessageData
+from ocpp2mqtt.relay.sockopts import tune_socket
+
+# High-water mark of the websocket write buffers. Bursts of messages are buffered
+# instead of waiting for the buffer to drain after every 32 KiB.
+WRITE_LIMIT = 2**20
 
 
 def basic_auth_header(username, password):
@@ -26,35 +32,98 @@ class OCPPRelay:
     relaying messages and passing a copy to a snoop queue makes it possible to
     map OCPP messages to MQTT topics without having to reimplement the OCPP."""
 
-    def __init__(self, csms_url, csms_id=None, csms_pass=None, snoop_queue=None):
+    def __init__(self, csms_url, csms_id=None, csms_pass=None, snoop_queue=None,
+                 snoop_enabled=None, socket_buffer_size=None):
         if csms_url is None:
             raise ValueError("csms_url must not be None")
         self.logger = logging.getLogger()
         self.csms_url, self.csms_id, self.csms_pass = csms_url, csms_id, csms_pass
+        # Charge point IDs are appended to the CSMS URL
+        self._csms_url_prefix = csms_url.rstrip("/")
+        # Headers sent with every connection to the CSMS
+        self._extra_headers = []
+        if csms_id and csms_pass:
+            self._extra_headers.append(basic_auth_header(csms_id, csms_pass))
         self.snoop_queue = snoop_queue
+        # Optional callable that returns False when nobody is reading the snoop
+        # queue, e.g. SnoopWebSocketServer.has_subscribers.
+        self.snoop_enabled = snoop_enabled
+        self.socket_buffer_size = socket_buffer_size
+        # Number of messages dropped because the snoop queue was full
+        self.snoop_dropped = 0
 
     async def _relay(self, source_ws, target_ws, source_name, target_name, cp_id, protocol):
         while True:
-            message = await source_ws.recv()
-            json_message = json.loads(message)
-            await target_ws.send(message)
-            self.logger.info(f"Relayed message from {source_name} to {target_name} ({json_message[1]})")
-
-            # Pass the message to the snoop queue
-            if self.snoop_queue:
-                msg_data = MessageData(event="Message", sender=source_name, protocol=protocol, cp_id=cp_id, payload=json_message)
+            # Receive the frame as bytes without decoding it. OCPP-J only uses text
+            # frames, so it is sent on as text. UTF-8 is only checked for the snoop copy.
+            message = await source_ws.recv(decode=False)
+            # Relay first. Parsing is only needed for the log and the snoop queue.
+            await target_ws.send(message, text=True)
+
+            snoop = self.snoop_queue and (self.snoop_enabled is None or self.snoop_enabled())
+            if not snoop and not self.logger.isEnabledFor(logging.INFO):
+                continue
+
+            # The frame has already been relayed. If it isn't a valid OCPP message, only
+            # the log line and the snoop copy are skipped, whatever the log level.
+            json_message = None
+            try:
+                if self.logger.isEnabledFor(logging.INFO):
+                    json_message = orjson.loads(message)
+                    self.logger.info("Relayed message from %s to %s (%s)", source_name, target_name, json_message[1])
+                if snoop and json_message is None and b"\n" in message:
+                    json_message = orjson.loads(message)
+            except (orjson.JSONDecodeError, TypeError, IndexError, KeyError) as e:
+                self.logger.warning("Invalid message from %s to %s not passed to snoop clients: %s",
+                                    source_name, target_name, e)
+                continue
+
+            # Pass the message to the snoop queue. The frame is embedded in the snoop
+            # message as is, unless it holds a newline that would break NDJSON framing.
+            # Snoop frames are sent as text, so the embedded bytes must be valid UTF-8.
+            # orjson has already checked them if the frame was parsed.
+            if snoop:
+                if b"\n" in message:
+                    payload = json_message
+                else:
+                    if json_message is None:
+                        try:
+                            message.decode()
+                        except UnicodeDecodeError as e:
+                            self.logger.warning("Invalid message from %s to %s not passed to snoop clients: %s",
+                                                source_name, target_name, e)
+                            continue
+                    payload = msgspec.Raw(message)
+                msg_data = MessageData(event="Message", sender=source_name, protocol=protocol, cp_id=cp_id, payload=payload)
+                self._put_snoop(msg_data)
+
+    def _put_snoop(self, msg_data):
+        """Add msg_data to the snoop queue. When the queue is bounded and full, the
+        oldest message is dropped. Relaying is never blocked by snoop clients."""
+        try:
+            self.snoop_queue.put_nowait(msg_data)
+        except asyncio.QueueFull:
+            try:
+                self.snoop_queue.get_nowait()
                 self.snoop_queue.put_nowait(msg_data)
+            except (asyncio.QueueEmpty, asyncio.QueueFull):
+                pass
+            self.snoop_dropped += 1
+            if self.snoop_dropped % 1000 == 1:
+                self.logger.warning(f"Snoop queue full, {self.snoop_dropped} messages dropped")
 
 
     async def _on_connect(self, ws):
+        tune_socket(ws, self.socket_buffer_size)
         self.logger.info(f"WebSocket OnConnect for path {ws.request.path} on {ws.local_address}")
-        self.logger.info(f"WebSocket request headers:\n{json.dumps(dict(ws.request.headers), indent=2)}")
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info("WebSocket request headers:\n%s",
+                             orjson.dumps(dict(ws.request.headers), option=orjson.OPT_INDENT_2).decode())
 
         charge_point_id = ws.request.path.strip("/")
         cp_ws = ws
-        try:
-            ws_subprotocol = cp_ws.request.headers["Sec-WebSocket-Protocol"]
-        except KeyError:
+        ws_subprotocol = cp_ws.request.headers.get("Sec-WebSocket-Protocol")
+        if ws_subprotocol is None:
             self.logger.error(
                 "Client didn't specify any sub-protocol. A sub-protocol is required for OCPP. Closing Connection."
             )
@@ -63,24 +132,25 @@ class OCPPRelay:
         self.logger.info(
             f"Received a new connection from a ChargePoint ID {charge_point_id}, protocol: {ws_subprotocol}"
         )
-        self.logger.info(f"Connecting to CSMS at {self.csms_url}/{charge_point_id}")
-
-        extra_headers = []
-        if all([self.csms_id, self.csms_pass]):
-            extra_headers.append(basic_auth_header(self.csms_id, self.csms_pass))
-
-        csms_uri = f"{self.csms_url}/{charge_point_id}"
+        csms_uri = f"{self._csms_url_prefix}/{charge_point_id}"
+        self.logger.info(f"Connecting to CSMS at {csms_uri}")
 
         # Connect to the CSMS and relay messages in both directions. If either
         # connection drops, return and wait for a new ChargePoint connection.
-        async with websockets.connect(csms_uri, subprotocols=[ws_subprotocol], additional_headers=extra_headers) as csms_ws:
+        async with websockets.connect(csms_uri, subprotocols=[ws_subprotocol], additional_headers=self._extra_headers,
+                                      write_limit=WRITE_LIMIT) as csms_ws:
+            tune_socket(csms_ws, self.socket_buffer_size)
             tasks = [
                 asyncio.create_task(self._relay(cp_ws, csms_ws, source_name="CP", target_name="CSMS", cp_id=charge_point_id, protocol=ws_subprotocol), name="CP"),
                 asyncio.create_task(self._relay(csms_ws, cp_ws, source_name="CSMS", target_name="CP", cp_id=charge_point_id, protocol=ws_subprotocol), name="CSMS")
             ]
 
             try:
-                await asyncio.gather(*tasks)
+                # Each direction runs until its connection fails. Stop at the first one
+                # and re-raise its exception for the handlers below.
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
             except asyncio.CancelledError:
                 # Propagate cancellations
                 raise
@@ -103,6 +173,7 @@ class OCPPRelay:
 
 
     async def start(self, host, port, ssl_context=None):
-        server = await websockets.serve(self._on_connect, host, port, ssl=ssl_context)
+        server = await websockets.serve(self._on_connect, host, port, ssl=ssl_context,
+                                        write_limit=WRITE_LIMIT)
         self.logger.info(f"Relay server started on {port}")
         return server
@@ -8,62 +8,114 @@
 ## A client could receive the JSON stream, look for messages about energy
 ## usage and forward messages to an MQTT broker.
 ##
+## Messages are framed as NDJSON: a websocket frame holds one or more JSON
+## objects separated by newlines. Clients must split frames on "\n".
+##
 
 import asyncio
-from dataclasses import asdict
-import json
 import logging
+import msgspec
 import websockets
 
+from ocpp2mqtt.common.types import encode_message
+from ocpp2mqtt.relay.sockopts import tune_socket
+
 class SnoopWebSocketServer:
     """WebSocket server that forwards OCPP messages from snoop_queue to all
     connected snoop clients.
     """
-    def __init__(self, snoop_queue):
+    def __init__(self, snoop_queue, socket_buffer_size=None, max_batch=64,
+                 client_queue_size=1024):
         if snoop_queue is None:
             raise ValueError("snoop_queue must be set")
 
         self.logger = logging.getLogger()
         self.snoop_queue = snoop_queue
+        # Maximum number of queued messages combined into one websocket frame
+        self.max_batch = max_batch
+        self.socket_buffer_size = socket_buffer_size
+        # Maximum number of frames waiting to be sent to one client
+        self.client_queue_size = client_queue_size
+        # Number of frames dropped because a client's queue was full
+        self.dropped = 0
 
-        # Set of currently connected snoop clients
-        self.snoop_sockets = set()
+        # Currently connected snoop clients, each mapped to its outbound queue
+        self.snoop_sockets = {}
 
         asyncio.create_task(self._forward_messages())
 
     async def _forward_messages(self):
         """The main worker task that consumes messages from the snoop queue and
         forwards them to the set of connected snoop clients. The same message
-        is sent to all connected clients."""
+        is sent to all connected clients. Messages that are already waiting in
+        the queue are sent together in one NDJSON frame."""
         while True:
-            msg = await self.snoop_queue.get()
-            self.logger.debug(f"Message from queue:\n{json.dumps(asdict(msg), indent=2)}")
+            batch = [await self.snoop_queue.get()]
+            while len(batch) < self.max_batch and not self.snoop_queue.empty():
+                batch.append(self.snoop_queue.get_nowait())
+            if not self.snoop_sockets:
+                continue
+
+            # Encode once. All clients are sent the same bytes.
+            encoded = [encode_message(msg) for msg in batch]
+            if self.logger.isEnabledFor(logging.DEBUG):
+                for msg_json in encoded:
+                    self.logger.debug(f"Message from queue:\n{msgspec.json.format(msg_json, indent=2).decode()}")
+            msg_json = b"\n".join(encoded)
 
-            msg_json = json.dumps(asdict(msg))
-            for ws in self.snoop_sockets.copy():
+            # Hand the frame to each client's writer task so that a slow client doesn't
+            # delay the others. When a client falls behind, its oldest frame is dropped.
+            for out_queue in self.snoop_sockets.values():
                 try:
-                    await ws.send(msg_json)
-                except Exception as e:
-                    self.logger.error(f"Error sending message to snoop client: {e}")
-                    self.snoop_sockets.remove(ws)
+                    out_queue.put_nowait(msg_json)
+                except asyncio.QueueFull:
+                    out_queue.get_nowait()
+                    out_queue.put_nowait(msg_json)
+                    self.dropped += 1
+                    if self.dropped % 1000 == 1:
+                        self.logger.warning(f"Snoop client too slow, {self.dropped} frames dropped")
+
+    async def _writer(self, ws, out_queue):
+        """Send frames from out_queue to one snoop client until sending fails."""
+        try:
+            while True:
+                msg_json = await out_queue.get()
+                # Encoded JSON is bytes. Keep sending it to clients as text frames.
+                await ws.send(msg_json, text=True)
+        except Exception as e:
+            self.logger.error(f"Error sending message to snoop client: {e}")
+            self.snoop_sockets.pop(ws, None)
+
+    def has_subscribers(self):
+        """True if at least one snoop client is connected."""
+        return bool(self.snoop_sockets)
 
     async def _relay(self, source_ws):
         while True:
             try:
                 message = await source_ws.recv()
-                self.logger.debug(f"Ignored message: ({message})")
+                self.logger.debug("Ignored message: (%s)", message)
             except (websockets.exceptions.ConnectionClosed, websockets.exceptions.ConnectionClosedOK):
                 self.logger.info(f"Snoop connection closed.")
                 break
 
     async def _on_connect(self, ws):
         self.logger.info(f"Received a new connection from a snoop client.")
-        self.snoop_sockets.add(ws)
-        await self._relay(ws)
-        self.snoop_sockets.remove(ws)
+        tune_socket(ws, self.socket_buffer_size)
+        out_queue = asyncio.Queue(maxsize=self.client_queue_size)
+        self.snoop_sockets[ws] = out_queue
+        writer = asyncio.create_task(self._writer(ws, out_queue))
+        try:
+            await self._relay(ws)
+        finally:
+            # The writer may already have dropped ws after a failed send
+            self.snoop_sockets.pop(ws, None)
+            writer.cancel()
 
-    async def start(self, host, port, ssl_context=None):
-        """Start the snoop WebSocket server on the given address and port."""
-        server = await websockets.serve(self._on_connect, host, port, ssl=ssl_context)
+    async def start(self, host, port, ssl_context=None, compression="deflate"):
+        """Start the snoop WebSocket server on the given address and port. Pass
+        compression=None to disable per-message deflate."""
+        server = await websockets.serve(self._on_connect, host, port, ssl=ssl_context,
+                                        compression=compression)
         self.logger.info(f"Snoop server started on {port}")
         return server
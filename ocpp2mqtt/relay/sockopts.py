@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+##
+## TCP options for relay and snoop connections. OCPP messages are small and
+## latency sensitive, so Nagle's algorithm is disabled on every connection.
+##
+
+import logging
+import socket
+
+
+def tune_socket(ws, buffer_size=None):
+    """Set TCP_NODELAY on the socket under a websocket connection. When buffer_size
+    is set, also use it for the socket's send and receive buffers. Otherwise the
+    operating system's default (usually auto-tuned) sizes are kept."""
+    sock = ws.transport.get_extra_info("socket")
+    if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return
+
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if buffer_size:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+    except OSError as e:
+        logging.getLogger().warning(f"Failed to set socket options: {e}")
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Project metadata is in pyproject.toml. This file only adds the optional
+# Cython build of modules on the per-message path. The modules are compiled
+# from their pure Python source, which remains the fallback when the package
+# is installed without OCPP2MQTT_CYTHON set.
+
+import os
+from setuptools import setup
+
+ext_modules = []
+if os.environ.get("OCPP2MQTT_CYTHON"):
+    from Cython.Build import cythonize
+    ext_modules = cythonize(
+        ["ocpp2mqtt/mqtt/ocppfilter.py"],
+        # Annotations describe the expected OCPP values but charge points send
+        # ints where strings are documented. Don't let Cython enforce them.
+        compiler_directives={"language_level": "3", "annotation_typing": False})
+
+setup(ext_modules=ext_modules)